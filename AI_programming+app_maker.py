@@ -1,40 +1,66 @@
 // server.js
+const os = require("os");
+
+// bcrypt hashes on the libuv threadpool; size it to the machine before first use
+process.env.UV_THREADPOOL_SIZE =
+  process.env.UV_THREADPOOL_SIZE || String(Math.max(os.cpus().length, 4));
+
 const express = require("express");
 const mongoose = require("mongoose");
-const bcrypt = require("bcryptjs");
+const { Types } = mongoose;
+const bcrypt = require("bcrypt");
 const jwt = require("jsonwebtoken");
 const multer = require("multer");
 const cors = require("cors");
+const compression = require("compression");
+const rateLimit = require("express-rate-limit");
+const { LRUCache } = require("lru-cache");
 const path = require("path");
 
 const app = express();
 const PORT = process.env.PORT || 5000;
 const JWT_SECRET = process.env.JWT_SECRET; // Use env variable in production
+const BCRYPT_ROUNDS = parseInt(process.env.BCRYPT_ROUNDS || "12", 10);
+const MAX_PROJECT_VERSIONS = 50; // older code versions are pruned
+
+// Compared against when a username doesn't exist so failed logins take equal time.
+// Uses BCRYPT_ROUNDS, the cost every active account converges to via rehash-on-login.
+const DUMMY_HASH = bcrypt.hashSync("not-a-real-password", BCRYPT_ROUNDS);
+
+// Building indexes at startup blocks; in production run `--sync-indexes` instead
+if (process.env.NODE_ENV === "production") mongoose.set("autoIndex", false);
 
 // Connect to MongoDB
 mongoose.connect(process.env.MONGO_URI, {
-  useNewUrlParser: true,
-  useUnifiedTopology: true,
+  maxPoolSize: 50,
+  minPoolSize: 5,
+  serverSelectionTimeoutMS: 5000,
+  socketTimeoutMS: 45000,
 });
 
 // --- Schemas ---
 
 const UserSchema = new mongoose.Schema({
-  username: { type: String, unique: true, required: true },
+  username: { type: String, required: true },
   passwordHash: { type: String, required: true },
 });
 
+UserSchema.index({ username: 1 }, { unique: true });
+
+// Code history lives in its own collection so project reads don't load it
 const VersionSchema = new mongoose.Schema({
+  projectId: { type: mongoose.Schema.Types.ObjectId, ref: "Project", required: true },
   code: String,
   createdAt: { type: Date, default: Date.now },
 });
 
+VersionSchema.index({ projectId: 1, createdAt: -1, _id: -1 });
+
 const ProjectSchema = new mongoose.Schema({
   ownerId: { type: mongoose.Schema.Types.ObjectId, ref: "User", required: true },
   title: { type: String, required: true },
   description: String,
   code: { type: String, required: true },
-  versions: [VersionSchema],
   assets: [String], // file URLs
   inputData: {
     text: String,
@@ -47,154 +73,273 @@ const ProjectSchema = new mongoose.Schema({
   updatedAt: { type: Date, default: Date.now },
 });
 
+// Supports the per-user project list sorted by most recently updated
+ProjectSchema.index({ ownerId: 1, updatedAt: -1 });
+// Supports public project lookups
+ProjectSchema.index({ isPublic: 1, _id: 1 });
+
 const User = mongoose.model("User", UserSchema);
 const Project = mongoose.model("Project", ProjectSchema);
+const ProjectVersion = mongoose.model("ProjectVersion", VersionSchema);
 
 // --- Middleware ---
 app.use(cors());
+// Negotiates gzip/brotli from Accept-Encoding; skips small responses
+app.use(compression({ threshold: 1024, level: 6 }));
 app.use(express.json());
 
 // Serve uploads folder statically
 app.use("/uploads", express.static(path.join(__dirname, "uploads")));
 
+// Limit credential endpoints per IP so they can't be used to burn bcrypt CPU
+const authLimiter = rateLimit({
+  windowMs: 60 * 1000,
+  max: 10,
+  standardHeaders: true,
+  legacyHeaders: false,
+  message: { message: "Too many requests, please try again later" },
+});
+
 // --- Auth Middleware ---
+
+// Verified token payloads, each kept only until its token expires
+const tokenCache = new LRUCache({ max: 10000 });
+
 function authenticateToken(req, res, next) {
   const authHeader = req.headers["authorization"];
   const token = authHeader && authHeader.split(" ")[1];
   if (!token) return res.status(401).json({ message: "Missing token" });
 
-  jwt.verify(token, JWT_SECRET, (err, user) => {
-    if (err) return res.status(403).json({ message: "Invalid token" });
-    req.user = user;
-    next();
-  });
+  const cached = tokenCache.get(token);
+  if (cached) {
+    req.user = cached;
+    return next();
+  }
+
+  let user;
+  try {
+    user = jwt.verify(token, JWT_SECRET);
+  } catch (err) {
+    return res.status(403).json({ message: "Invalid token" });
+  }
+
+  const ttl = user.exp * 1000 - Date.now();
+  if (ttl > 0) tokenCache.set(token, user, { ttl });
+  req.user = user;
+  next();
 }
 
-// --- Routes ---
+// --- Helpers ---
+const HTML_ESCAPES = {
+  "&": "&amp;",
+  "<": "&lt;",
+  ">": "&gt;",
+  '"': "&quot;",
+  "'": "&#39;",
+};
+
+function escapeHtml(str) {
+  return String(str).replace(/[&<>"']/g, (ch) => HTML_ESCAPES[ch]);
+}
 
-// Register
-app.post("/api/register", async (req, res) => {
-  try {
-    const { username, password } = req.body;
-    if (!username || !password)
-      return res.status(400).json({ message: "Username and password required" });
+// Rendered deployed pages; updatedAt in the key invalidates entries on edit.
+// Bounded by total bytes too, since stored code has no size limit.
+const deployedPageCache = new LRUCache({
+  max: 1000,
+  maxSize: 64 * 1024 * 1024,
+  maxEntrySize: 1024 * 1024, // larger pages are rendered per request, not cached
+  sizeCalculation: (buf) => buf.length,
+});
 
-    if (await User.findOne({ username })) {
-      return res.status(400).json({ message: "Username already taken" });
-    }
+function renderDeployedPage(project) {
+  // For security: sanitize or restrict code before serving in production!
+  return Buffer.from(
+    "<!DOCTYPE html><html><head><title>" +
+      escapeHtml(project.title) +
+      "</title></head><body>" +
+      project.code +
+      "</body></html>"
+  );
+}
+
+// Public responses only change when the project is updated, so updatedAt is the validator
+function setPublicCacheHeaders(res, updatedAt) {
+  res.set("Cache-Control", "public, max-age=60, stale-while-revalidate=300");
+  res.set("ETag", `W/"${updatedAt.getTime().toString(36)}"`);
+}
+
+// Filter for a project owned by the current user; anything else is a 404
+function ownedProjectFilter(req) {
+  return { _id: req.params.id, ownerId: new Types.ObjectId(req.user.id) };
+}
+
+// Forwards rejected promises from async route handlers to the error handler
+const ah = (fn) => (req, res, next) =>
+  Promise.resolve(fn(req, res, next)).catch(next);
+
+// Save a code version, dropping anything beyond the newest MAX_PROJECT_VERSIONS
+async function recordVersion(projectId, code) {
+  await ProjectVersion.create({ projectId, code });
+  const stale = await ProjectVersion.find({ projectId }, { _id: 1 })
+    .sort({ createdAt: -1, _id: -1 })
+    .skip(MAX_PROJECT_VERSIONS)
+    .lean();
+  if (stale.length)
+    await ProjectVersion.deleteMany({ _id: { $in: stale.map((v) => v._id) } });
+}
+
+// --- Routes ---
 
-    const passwordHash = await bcrypt.hash(password, 10);
-    const newUser = new User({ username, passwordHash });
-    await newUser.save();
+// Register
+app.post("/api/register", authLimiter, ah(async (req, res) => {
+  const { username, password } = req.body;
+  if (!username || !password)
+    return res.status(400).json({ message: "Username and password required" });
 
-    res.json({ message: "User registered successfully" });
+  // The unique username index rejects duplicates, so there is no pre-check
+  const passwordHash = await bcrypt.hash(password, BCRYPT_ROUNDS);
+  try {
+    await User.create({ username, passwordHash });
   } catch (err) {
-    res.status(500).json({ message: "Server error" });
+    if (err.code === 11000)
+      return res.status(400).json({ message: "Username already taken" });
+    throw err;
   }
-});
+
+  res.json({ message: "User registered successfully" });
+}));
 
 // Login
-app.post("/api/login", async (req, res) => {
-  try {
-    const { username, password } = req.body;
-    const user = await User.findOne({ username });
-    if (!user)
-      return res.status(400).json({ message: "Invalid username or password" });
-
-    const isMatch = await bcrypt.compare(password, user.passwordHash);
-    if (!isMatch)
-      return res.status(400).json({ message: "Invalid username or password" });
-
-    const token = jwt.sign(
-      { id: user._id, username: user.username },
-      JWT_SECRET,
-      { expiresIn: "12h" }
-    );
-    res.json({ token });
-  } catch (err) {
-    res.status(500).json({ message: "Server error" });
+app.post("/api/login", authLimiter, ah(async (req, res) => {
+  const { username, password } = req.body;
+  const user = await User.findOne(
+    { username },
+    { passwordHash: 1, username: 1 }
+  ).lean();
+  const isMatch = await bcrypt.compare(
+    password || "",
+    user ? user.passwordHash : DUMMY_HASH
+  );
+  if (!user || !isMatch)
+    return res.status(400).json({ message: "Invalid username or password" });
+
+  // Upgrade hashes made with an older cost factor while we have the password
+  if (bcrypt.getRounds(user.passwordHash) !== BCRYPT_ROUNDS) {
+    const passwordHash = await bcrypt.hash(password, BCRYPT_ROUNDS);
+    await User.updateOne({ _id: user._id }, { $set: { passwordHash } });
   }
-});
+
+  const token = jwt.sign(
+    { id: user._id, username: user.username },
+    JWT_SECRET,
+    { expiresIn: "12h" }
+  );
+  res.json({ token });
+}));
 
 // Create Project with input data
-app.post("/api/projects", authenticateToken, async (req, res) => {
-  try {
-    const { title, description, code, inputData, isPublic } = req.body;
-    if (!title || !code)
-      return res.status(400).json({ message: "Title and code required" });
-
-    const project = new Project({
-      ownerId: req.user.id,
-      title,
-      description,
-      code,
-      versions: [{ code }],
-      inputData: inputData || {},
-      isPublic: !!isPublic,
-      assets: [],
-    });
+app.post("/api/projects", authenticateToken, ah(async (req, res) => {
+  const { title, description, code, inputData, isPublic } = req.body;
+  if (!title || !code)
+    return res.status(400).json({ message: "Title and code required" });
+
+  const project = new Project({
+    ownerId: req.user.id,
+    title,
+    description,
+    code,
+    inputData: inputData || {},
+    isPublic: !!isPublic,
+    assets: [],
+  });
 
-    await project.save();
-    res.json(project);
-  } catch (err) {
-    res.status(500).json({ message: "Server error" });
-  }
-});
+  await project.save();
+  await ProjectVersion.create({ projectId: project._id, code });
+  res.json(project);
+}));
 
 // Get user projects
-app.get("/api/projects", authenticateToken, async (req, res) => {
-  try {
-    const projects = await Project.find({ ownerId: req.user.id }).sort({
-      updatedAt: -1,
-    });
-    res.json(projects);
-  } catch (err) {
-    res.status(500).json({ message: "Server error" });
-  }
-});
+app.get("/api/projects", authenticateToken, ah(async (req, res) => {
+  // List view only needs summary fields; full documents come from GET /api/projects/:id
+  const projects = await Project.find(
+    { ownerId: req.user.id },
+    { title: 1, description: 1, updatedAt: 1, isPublic: 1, deployedUrl: 1 }
+  )
+    .sort({ updatedAt: -1 })
+    .lean();
+  res.json(projects);
+}));
 
 // Get public project by ID
-app.get("/api/projects/public/:id", async (req, res) => {
-  try {
-    const project = await Project.findOne({
-      _id: req.params.id,
-      isPublic: true,
-    });
-    if (!project)
-      return res.status(404).json({ message: "Project not found or not public" });
+app.get("/api/projects/public/:id", ah(async (req, res) => {
+  const filter = { _id: req.params.id, isPublic: true };
+  const meta = await Project.findOne(filter, { updatedAt: 1 }).lean();
+  if (!meta)
+    return res.status(404).json({ message: "Project not found or not public" });
 
-    res.json(project);
-  } catch (err) {
-    res.status(500).json({ message: "Server error" });
-  }
-});
+  setPublicCacheHeaders(res, meta.updatedAt);
+  if (req.fresh) return res.status(304).end();
 
-// Update project + versioning
-app.put("/api/projects/:id", authenticateToken, async (req, res) => {
-  try {
-    const { title, description, code, inputData, isPublic } = req.body;
-    const project = await Project.findById(req.params.id);
-    if (!project) return res.status(404).json({ message: "Project not found" });
-    if (project.ownerId.toString() !== req.user.id)
-      return res.status(403).json({ message: "Not authorized" });
-
-    if (title) project.title = title;
-    if (description) project.description = description;
-    if (code && code !== project.code) {
-      project.code = code;
-      project.versions.push({ code });
-    }
-    if (inputData) project.inputData = inputData;
-    if (typeof isPublic === "boolean") project.isPublic = isPublic;
+  // versions: 0 hides legacy embedded history until --migrate-versions has run
+  const project = await Project.findOne(filter, { versions: 0 }).lean();
+  if (!project)
+    return res.status(404).json({ message: "Project not found or not public" });
 
-    project.updatedAt = new Date();
+  res.json(project);
+}));
 
-    await project.save();
-    res.json(project);
-  } catch (err) {
-    res.status(500).json({ message: "Server error" });
-  }
-});
+// Get single project (full detail)
+app.get("/api/projects/:id", authenticateToken, ah(async (req, res) => {
+  const project = await Project.findOne(ownedProjectFilter(req), { versions: 0 }).lean();
+  if (!project) return res.status(404).json({ message: "Project not found" });
+
+  res.json(project);
+}));
+
+// Update project + versioning
+app.put("/api/projects/:id", authenticateToken, ah(async (req, res) => {
+  const { title, description, code, inputData, isPublic } = req.body;
+  const update = { updatedAt: new Date() };
+  if (title) update.title = title;
+  if (description) update.description = description;
+  if (code) update.code = code;
+  if (inputData) update.inputData = inputData;
+  if (typeof isPublic === "boolean") update.isPublic = isPublic;
+
+  // Single atomic update; the pre-update code tells us whether to record a version
+  const previous = await Project.findOneAndUpdate(
+    ownedProjectFilter(req),
+    { $set: update },
+    { new: false, projection: { code: 1 } }
+  ).lean();
+  if (!previous) return res.status(404).json({ message: "Project not found" });
+
+  if (code && code !== previous.code) await recordVersion(previous._id, code);
+
+  // Re-read so the response reflects the values Mongoose cast and stored
+  const project = await Project.findById(previous._id, { versions: 0 }).lean();
+  res.json(project);
+}));
+
+// Get project version history (newest first, paginated)
+app.get("/api/projects/:id/versions", authenticateToken, ah(async (req, res) => {
+  const project = await Project.findOne(ownedProjectFilter(req), { _id: 1 }).lean();
+  if (!project) return res.status(404).json({ message: "Project not found" });
+
+  const page = Math.max(parseInt(req.query.page, 10) || 1, 1);
+  const limit = Math.min(Math.max(parseInt(req.query.limit, 10) || 20, 1), 100);
+
+  const versions = await ProjectVersion.find(
+    { projectId: project._id },
+    { code: 1, createdAt: 1 }
+  )
+    .sort({ createdAt: -1, _id: -1 })
+    .skip((page - 1) * limit)
+    .limit(limit)
+    .lean();
+
+  res.json({ page, limit, versions });
+}));
 
 // Upload asset (image/drawing)
 app.post(
@@ -211,68 +356,153 @@ app.post(
 );
 
 // Add asset URL to project
-app.post("/api/projects/:id/assets", authenticateToken, async (req, res) => {
-  try {
-    const { url } = req.body;
-    if (!url) return res.status(400).json({ message: "Missing asset URL" });
-
-    const project = await Project.findById(req.params.id);
-    if (!project) return res.status(404).json({ message: "Project not found" });
-    if (project.ownerId.toString() !== req.user.id)
-      return res.status(403).json({ message: "Not authorized" });
+app.post("/api/projects/:id/assets", authenticateToken, ah(async (req, res) => {
+  const { url } = req.body;
+  if (!url) return res.status(400).json({ message: "Missing asset URL" });
 
-    project.assets.push(url);
-    project.updatedAt = new Date();
-    await project.save();
+  const project = await Project.findOneAndUpdate(
+    ownedProjectFilter(req),
+    { $push: { assets: url }, $set: { updatedAt: new Date() } },
+    { new: true, projection: { assets: 1, updatedAt: 1 } }
+  ).lean();
+  if (!project) return res.status(404).json({ message: "Project not found" });
 
-    res.json(project);
-  } catch (err) {
-    res.status(500).json({ message: "Server error" });
-  }
-});
+  res.json(project);
+}));
 
 // Deploy project (simulate deployment, assign public URL)
-app.post("/api/projects/:id/deploy", authenticateToken, async (req, res) => {
-  try {
-    const project = await Project.findById(req.params.id);
-    if (!project) return res.status(404).json({ message: "Project not found" });
-    if (project.ownerId.toString() !== req.user.id)
-      return res.status(403).json({ message: "Not authorized" });
-
-    // Simulate deployment by assigning a public URL path
-    project.deployedUrl = `/deployed/${project._id}`;
-    project.isPublic = true; // deployment implies public access
-    project.updatedAt = new Date();
-    await project.save();
-
-    res.json({ deployedUrl: project.deployedUrl });
-  } catch (err) {
-    res.status(500).json({ message: "Server error" });
-  }
-});
+app.post("/api/projects/:id/deploy", authenticateToken, ah(async (req, res) => {
+  if (!mongoose.isObjectIdOrHexString(req.params.id))
+    return res.status(404).json({ message: "Project not found" });
+  // Canonical id, so the stored URL doesn't depend on how the client spelled it
+  const projectId = new Types.ObjectId(req.params.id);
+
+  // Simulate deployment by assigning a public URL path
+  const project = await Project.findOneAndUpdate(
+    ownedProjectFilter(req),
+    {
+      $set: {
+        deployedUrl: `/deployed/${projectId}`,
+        isPublic: true, // deployment implies public access
+        updatedAt: new Date(),
+      },
+    },
+    { new: true, projection: { deployedUrl: 1 } }
+  ).lean();
+  if (!project) return res.status(404).json({ message: "Project not found" });
+
+  res.json({ deployedUrl: project.deployedUrl });
+}));
 
 // Serve deployed projects publicly by rendering stored code (simplified)
-app.get("/deployed/:projectId", async (req, res) => {
-  try {
-    const project = await Project.findById(req.params.projectId);
-    if (!project || !project.isPublic || !project.deployedUrl)
+app.get("/deployed/:projectId", ah(async (req, res) => {
+  const meta = await Project.findById(req.params.projectId, {
+    isPublic: 1,
+    deployedUrl: 1,
+    updatedAt: 1,
+  }).lean();
+  if (!meta || !meta.isPublic || !meta.deployedUrl)
+    return res.status(404).send("Project not found or not deployed");
+
+  setPublicCacheHeaders(res, meta.updatedAt);
+  if (req.fresh) return res.status(304).end();
+
+  // Title and code are only read when the page isn't already rendered
+  const key = `${meta._id}:${meta.updatedAt.getTime()}`;
+  let page = deployedPageCache.get(key);
+  if (!page) {
+    const project = await Project.findById(meta._id, { title: 1, code: 1 }).lean();
+    if (!project)
       return res.status(404).send("Project not found or not deployed");
+    page = renderDeployedPage(project);
+    deployedPageCache.set(key, page);
+  }
 
-    // For security: sanitize or restrict code before serving in production!
-    res.send(`
-      <!DOCTYPE html>
-      <html>
-      <head><title>${project.title}</title></head>
-      <body>
-      ${project.code}
-      </body>
-      </html>
-    `);
-  } catch (err) {
-    res.status(500).send("Server error");
+  res.type("html").send(page);
+}));
+
+// --- Error Handler ---
+app.use((err, req, res, next) => {
+  if (res.headersSent) return next(err);
+
+  // Client errors (e.g. malformed JSON from express.json()) keep their status
+  const status = err.status || err.statusCode || 500;
+  let message = err.expose ? err.message : "Bad request";
+  if (status >= 500) {
+    console.error(err);
+    message = "Server error";
   }
-});
 
-app.listen(PORT, () => {
-  console.log(`Server running on port ${PORT}`);
+  if (req.path.startsWith("/api/"))
+    return res.status(status).json({ message });
+  res.status(status).send(message);
 });
+
+// Copy legacy embedded `versions[]` into ProjectVersion, then drop the arrays.
+// Version _ids are kept, so re-running after a partial failure is safe.
+async function migrateVersions() {
+  const cursor = Project.collection.find(
+    { versions: { $exists: true } },
+    { projection: { versions: 1 } }
+  );
+  for await (const project of cursor) {
+    const docs = (project.versions || []).map((v) => ({
+      _id: v._id,
+      projectId: project._id,
+      code: v.code,
+      createdAt: v.createdAt,
+    }));
+    if (docs.length) {
+      try {
+        await ProjectVersion.collection.insertMany(docs, { ordered: false });
+      } catch (err) {
+        // Duplicates are versions copied by an earlier run
+        if (!err.writeErrors || !err.writeErrors.every((e) => e.code === 11000))
+          throw err;
+      }
+    }
+    await Project.collection.updateOne(
+      { _id: project._id },
+      { $unset: { versions: 1 } }
+    );
+  }
+}
+
+// One-off maintenance tasks, e.g. `node server.js --sync-indexes`
+function runTask(task, doneMessage) {
+  // Native collection methods don't buffer, so wait for the connection first
+  mongoose.connection
+    .asPromise()
+    .then(() => task())
+    .then(() => {
+      console.log(doneMessage);
+      return mongoose.disconnect();
+    })
+    .catch((err) => {
+      console.error(err);
+      process.exitCode = 1;
+      return mongoose.disconnect();
+    });
+}
+
+if (process.argv.includes("--sync-indexes")) {
+  runTask(
+    () => Promise.all([User, Project, ProjectVersion].map((model) => model.syncIndexes())),
+    "Indexes synced"
+  );
+} else if (process.argv.includes("--migrate-versions")) {
+  runTask(migrateVersions, "Project versions migrated");
+} else {
+  // Registration relies on the unique username index to reject duplicates, so
+  // make sure it exists even when autoIndex is off
+  User.createIndexes()
+    .then(() => {
+      app.listen(PORT, () => {
+        console.log(`Server running on port ${PORT}`);
+      });
+    })
+    .catch((err) => {
+      console.error(err);
+      process.exit(1);
+    });
+}